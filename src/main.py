@@ -3,6 +3,52 @@ from bullmq import Worker, Job
 import asyncio
 import signal
 import os
+import logging
+import time
+import numpy as np
+
+logger = logging.getLogger("yolo-worker")
+
+# Model paths: FP32 weights are only kept as the export source,
+# inference always runs on the TensorRT engine
+WEIGHTS_PATH = 'src/best.pt'
+ENGINE_PATH = 'src/best.engine'
+
+# Module-level model singleton shared across jobs
+MODEL = None
+MODEL_LOCK = asyncio.Lock()
+
+def load_model():
+    # Blocking export/load/warmup; runs in a worker thread via get_model
+    if not os.path.exists(ENGINE_PATH):
+        # One-time export: fuses conv+BN+activation and enables
+        # FP16 Tensor Core kernels
+        YOLO(WEIGHTS_PATH).export(
+            format="engine",
+            imgsz=640,
+            half=True,
+            dynamic=True,
+            batch=16,
+            device=0
+        )
+    model = YOLO(ENGINE_PATH)
+
+    # Warm up once so the first job doesn't pay CUDA context
+    # and engine activation costs
+    model.predict(np.zeros((640, 640, 3), np.uint8), verbose=False)
+    return model
+
+async def get_model():
+    # Lazily load the TensorRT engine once and reuse it for every job
+    global MODEL
+    if MODEL is None:
+        async with MODEL_LOCK:
+            # Re-check inside the lock in case another job just loaded it
+            if MODEL is None:
+                # The export can take minutes; keep it off the event loop so
+                # BullMQ heartbeats and progress updates aren't starved
+                MODEL = await asyncio.to_thread(load_model)
+    return MODEL
 
 # Define the prediction function that will be used by BullMQ worker
 async def predict(job: Job, token=None):
@@ -10,62 +56,90 @@ async def predict(job: Job, token=None):
         # Extract parameters from job data
         video_path = "media/input.mp4"
         confidence = 0.25
-        model_path = 'src/best.pt'
-        
+
         # Validate input
         if not video_path or not os.path.exists(video_path):
             await job.updateProgress(100)  # Mark job as complete even though it failed
             return {"status": "error", "message": f"Video file not found: {video_path}"}
 
-        # Load model
-        model = YOLO(model_path)
-        
-        # Track total batches for progress calculation
-        # We need to calculate total frames first
-        import cv2
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        cap.release()
-        
-        # Store job reference for callback use
-        job_ref = job
-        
+        # Get the shared model (loaded once, reused across jobs)
+        model = await get_model()
+
+        # Progress values flow from the inference thread through a queue
+        # drained by a single reporter task, instead of scheduling one
+        # coroutine per batch from the callback
+        loop = asyncio.get_running_loop()
+        progress_queue = asyncio.Queue()
+
+        # Timestamp of the last progress log line
+        last_log = [0.0]
+
         # Define progress callback
         def on_predict_batch_end(predictor):
             # Get current batch number (add 1 because it's zero-indexed)
             current_batch = predictor.batch_i + 1
-            
+
             # Get total batches
             total_batches = len(predictor.dataset)
-            
+
             # Calculate progress percentage (0-100)
             progress = min(int((current_batch / total_batches) * 100), 100)
-            
-            # Update BullMQ job progress
-            asyncio.create_task(job_ref.updateProgress(progress))
-            
-            # Print progress for logging
-            print(f'Processing batch {current_batch}/{total_batches} - {progress}% complete')
-            
-            
-            # You can add additional processing here if needed
-
-        # Register callback
-        model.add_callback("on_predict_batch_end", on_predict_batch_end)
-        
+
+            # Hand the value to the reporter on the event loop thread
+            loop.call_soon_threadsafe(progress_queue.put_nowait, progress)
+
+            # Log at most once per second instead of once per batch
+            now = time.monotonic()
+            if now - last_log[0] > 1.0 or progress == 100:
+                logger.info('Processing batch %d/%d - %d%% complete', current_batch, total_batches, progress)
+                last_log[0] = now
+
+        async def report_progress():
+            # Single reporter: one updateProgress in flight at a time
+            last_reported = -1
+            while True:
+                progress = await progress_queue.get()
+
+                # Collapse any backlog so only the newest value is reported
+                while progress is not None and not progress_queue.empty():
+                    progress = progress_queue.get_nowait()
+
+                if progress is None:
+                    break
+                if progress != last_reported:
+                    await job.updateProgress(progress)
+                    last_reported = progress
+
+        # Register callback, replacing whatever previous jobs left behind:
+        # add_callback only appends, and on the shared singleton stale
+        # closures would keep pushing into finished jobs' queues forever
+        model.callbacks["on_predict_batch_end"] = [on_predict_batch_end]
+
         # Initialize progress
         await job.updateProgress(0)
-        
-        # Run prediction
-        results = model.predict(source=video_path, conf=confidence)
-        
+
+        # Start the reporter before inference begins
+        reporter = asyncio.create_task(report_progress())
+
+        # Run prediction in a dedicated thread so the blocking inference
+        # doesn't stall the event loop (BullMQ heartbeats, progress updates)
+        try:
+            results = await asyncio.to_thread(
+                model.predict, source=video_path, conf=confidence
+            )
+        finally:
+            # Stop the reporter (sentinel) and wait for it to flush
+            progress_queue.put_nowait(None)
+            await reporter
+
         # Ensure progress is at 100% when complete
         await job.updateProgress(100)
         
-        # Return success result
+        # Return success result; the predictor already counted the frames,
+        # so no separate metadata probe is needed
         return {
             "status": "success",
-            "processed_frames": total_frames,
+            "processed_frames": len(results),
         }
         
     except Exception as e:
@@ -78,29 +152,32 @@ async def main():
     shutdown_event = asyncio.Event()
 
     def signal_handler(signal, frame):
-        print("Signal received, shutting down.")
+        logger.info("Signal received, shutting down.")
         shutdown_event.set()
 
     # Assign signal handlers to SIGTERM and SIGINT
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
-    # Redis connection settings
-    redis_connection = {
-        "connection": "redis://default:password@/localhost:6379"
+    # Worker settings: one job at a time, since a single GPU can't run
+    # two inference pipelines without contending
+    worker_opts = {
+        "connection": "redis://default:password@/localhost:6379",
+        "concurrency": 1
     }
 
     # Create worker with prediction function
-    worker = Worker("videoProcessingQueue", predict, redis_connection)
-    print("Worker started and waiting for jobs...")
+    worker = Worker("videoProcessingQueue", predict, worker_opts)
+    logger.info("Worker started and waiting for jobs...")
 
     # Wait until the shutdown event is set
     await shutdown_event.wait()
 
     # Close the worker
-    print("Cleaning up worker...")
+    logger.info("Cleaning up worker...")
     await worker.close()
-    print("Worker shut down successfully.")
+    logger.info("Worker shut down successfully.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
\ No newline at end of file
@@ -3,45 +3,210 @@ from bullmq import Worker, Job
 import asyncio
 import signal
 import os
-import json
+import orjson
+import subprocess
+import threading
 import time
+import logging
 import cv2
 from pathlib import Path
 import numpy as np
+import torch
+
+logger = logging.getLogger("yolo-worker")
+
+# GPU video decode via NVDEC when decord is available; otherwise fall back
+# to OpenCV CPU decode
+try:
+    import decord
+    from decord import VideoReader, gpu
+    HAS_DECORD = True
+except ImportError:
+    HAS_DECORD = False
+
+# Model paths: FP32 weights are only kept as the export source,
+# inference always runs on the TensorRT engine
+WEIGHTS_PATH = 'src/best.pt'
+ENGINE_PATH = 'src/best.engine'
+
+# Frames fed to the model per inference call; matches the engine's export batch
+BATCH_SIZE = 16
+
+# Model input size used for export and inference
+IMGSZ = 640
+
+def probe_video(video_path):
+    # Read video metadata with a single ffprobe call instead of spinning up
+    # a full decoder pipeline just to query four properties. Falls back to
+    # OpenCV if ffprobe is not installed.
+    try:
+        out = subprocess.run(
+            [
+                'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+                '-show_entries', 'stream=nb_frames,r_frame_rate,width,height',
+                '-of', 'json', video_path
+            ],
+            capture_output=True, check=True
+        )
+        stream = orjson.loads(out.stdout)['streams'][0]
+
+        # r_frame_rate is a rational like "30000/1001"
+        num, _, den = stream['r_frame_rate'].partition('/')
+        fps = float(num) / float(den or 1)
+
+        return int(stream['nb_frames']), fps, int(stream['width']), int(stream['height'])
+    except (OSError, subprocess.CalledProcessError, KeyError, IndexError, ValueError, ZeroDivisionError):
+        cap = cv2.VideoCapture(video_path)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        cap.release()
+        return total_frames, fps, width, height
+
+def read_batches(video_path):
+    # Yield batches of frames for inference. With decord the frames are
+    # decoded by NVDEC straight into a CUDA tensor ([B, H, W, 3] RGB uint8),
+    # skipping the CPU decode and the host->device copy. The OpenCV fallback
+    # yields lists of BGR numpy frames.
+    if HAS_DECORD:
+        decord.bridge.set_bridge('torch')
+        vr = VideoReader(video_path, ctx=gpu(0))
+        for start in range(0, len(vr), BATCH_SIZE):
+            yield vr.get_batch(range(start, min(start + BATCH_SIZE, len(vr))))
+    else:
+        cap = cv2.VideoCapture(video_path)
+        try:
+            while True:
+                frames = []
+                while len(frames) < BATCH_SIZE:
+                    ok, frame = cap.read()
+                    if not ok:
+                        break
+                    frames.append(frame)
+                if not frames:
+                    break
+                yield frames
+        finally:
+            cap.release()
+
+# Module-level model singleton shared across jobs
+MODEL = None
+MODEL_LOCK = asyncio.Lock()
+
+# Frames sampled from the source video for INT8 calibration
+CALIB_FRAMES = 64
+
+def build_calibration_set(video_path, calib_dir, names):
+    # Sample representative frames evenly across the video and write the
+    # small dataset yaml the TensorRT INT8 calibrator expects
+    calib_dir = Path(calib_dir)
+    images_dir = calib_dir / "images"
+    images_dir.mkdir(parents=True, exist_ok=True)
+
+    cap = cv2.VideoCapture(video_path)
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(total // CALIB_FRAMES, 1)
+    for i in range(0, total, step):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
+        ok, frame = cap.read()
+        if not ok:
+            break
+        cv2.imwrite(str(images_dir / f"calib_{i:06d}.jpg"), frame)
+    cap.release()
+
+    yaml_path = calib_dir / "calib.yaml"
+    with open(yaml_path, 'w') as f:
+        f.write(f"path: {calib_dir.resolve()}\n")
+        f.write("train: images\n")
+        f.write("val: images\n")
+        f.write("names:\n")
+        for i, name in names.items():
+            f.write(f"  {i}: {name}\n")
+    return yaml_path
+
+def load_model():
+    # Blocking export/load/warmup; runs in a worker thread via get_model
+    if not os.path.exists(ENGINE_PATH):
+        # One-time export: fuses conv+BN+activation and runs on
+        # quantized Tensor Core kernels
+        source = YOLO(WEIGHTS_PATH)
+        try:
+            # INT8 engine, calibrated on frames sampled from the
+            # source video, for ~2x throughput over FP16
+            calib_yaml = build_calibration_set(
+                "media/input.mp4", "temp_results/calib", source.names
+            )
+            source.export(
+                format="engine",
+                imgsz=IMGSZ,
+                int8=True,
+                data=str(calib_yaml),
+                dynamic=True,
+                batch=16,
+                workspace=4,
+                device=0
+            )
+        except Exception as e:
+            # Calibration can fail (missing source video, bad
+            # sample set); fall back to the FP16 engine
+            logger.warning("INT8 export failed (%s), falling back to FP16", e)
+            source.export(
+                format="engine",
+                imgsz=IMGSZ,
+                half=True,
+                dynamic=True,
+                batch=16,
+                device=0
+            )
+    model = YOLO(ENGINE_PATH)
+
+    # Warm up once so the first job doesn't pay CUDA context
+    # and engine activation costs
+    model.predict(np.zeros((IMGSZ, IMGSZ, 3), np.uint8), verbose=False)
+    return model
+
+async def get_model():
+    # Lazily load the TensorRT engine once and reuse it for every job
+    global MODEL
+    if MODEL is None:
+        async with MODEL_LOCK:
+            # Re-check inside the lock in case another job just loaded it
+            if MODEL is None:
+                # The export and INT8 calibration can take minutes; keep
+                # them off the event loop so BullMQ heartbeats and progress
+                # updates aren't starved
+                MODEL = await asyncio.to_thread(load_model)
+    return MODEL
 
 # Define the prediction function that will be used by BullMQ worker
 async def predict(job: Job, token=None):
+    # Create the job's output directory once up front; every later write
+    # (results, NDJSON, error files) reuses it
+    job_id = job.id
+    output_dir = Path(f"./temp_results/{job_id}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+
     try:
         # Extract parameters from job data
         video_path = "media/input.mp4"
         confidence = 0.25
-        model_path = 'src/best.pt'
-        
-        # Create output directory for temporary JSON files
-        job_id = job.id
-        output_dir = Path(f"./temp_results/{job_id}")
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
+
         # Final JSON result path
         final_json_path = output_dir / "results.json"
-        
+
         # Validate input
         if not video_path or not os.path.exists(video_path):
             await job.updateProgress(100)  # Mark job as complete even though it failed
             save_error_json(final_json_path, f"Video file not found: {video_path}")
             return {"status": "error", "message": f"Video file not found: {video_path}"}
 
-        # Load YOLO model
-        model = YOLO(model_path)
-        
-        # Calculate total frames for progress tracking
-        cap = cv2.VideoCapture(video_path)
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        cap.release()
-        
+        # Get the shared model (loaded once, reused across jobs)
+        model = await get_model()
+
+        # Probe video metadata for progress tracking and box scaling
+        total_frames, fps, width, height = probe_video(video_path)
+
         # Store metadata in JSON
         metadata = {
             "video_info": {
@@ -53,61 +218,106 @@ async def predict(job: Job, token=None):
             },
             "job_info": {
                 "id": job_id,
-                "model": model_path,
+                "model": ENGINE_PATH,
                 "confidence": confidence
-            },
-            "frames": []
-        }
-        
-        # Save initial metadata
-        with open(final_json_path, 'w') as f:
-            json.dump(metadata, f)
-        
-        # Function to extract detection data from a frame result
-        def extract_frame_data(result, frame_number):
-            # Get bounding boxes, classes, and confidence scores
-            boxes = result.boxes.cpu().numpy()
-            
-            detections = []
-            if len(boxes) > 0:
-                for box in boxes:
-                    # Convert box coordinates to JSON-serializable format
-                    xyxy = box.xyxy[0].tolist() if hasattr(box, 'xyxy') else []
-                    conf = float(box.conf[0]) if hasattr(box, 'conf') else 0.0
-                    cls = int(box.cls[0]) if hasattr(box, 'cls') else -1
-                    
-                    # Get class name if available
-                    cls_name = result.names[cls] if hasattr(result, 'names') and cls in result.names else "unknown"
-                    
-                    detections.append({
-                        "bbox": xyxy,  # [x1, y1, x2, y2]
-                        "confidence": conf,
-                        "class_id": cls,
-                        "class_name": cls_name
-                    })
-            
-            return {
-                "frame_number": frame_number,
-                "timestamp": frame_number / fps if fps > 0 else 0,
-                "detections": detections
             }
-        
-        # Function to update JSON file with new frame data
-        def update_json_results(json_path, frame_data):
-            try:
-                # Load current JSON
-                with open(json_path, 'r') as f:
-                    data = json.load(f)
-                
-                # Append new frame data
-                data["frames"].append(frame_data)
-                
-                # Save updated JSON
-                with open(json_path, 'w') as f:
-                    json.dump(data, f)
-            except Exception as e:
-                print(f"Error updating JSON: {e}")
-        
+        }
+
+        # Frame records are appended one JSON object per line (NDJSON) and
+        # only wrapped into the final JSON once at completion, so writing
+        # frame N costs O(1) instead of re-serializing all previous frames
+        ndjson_path = output_dir / "frames.ndjson"
+
+        # Function to extract detection data from a whole batch of results
+        # as ready-to-write NDJSON lines. Detections stay on the GPU until a
+        # single batched device->host transfer instead of one sync per frame.
+        # Class names cached once per job as a tuple of pre-escaped JSON
+        # string literals indexed by class id (ids are dense 0..K-1)
+        class_names_json = None
+
+        def extract_batch_data(results, first_frame_number, letterbox=None):
+            nonlocal class_names_json
+            if class_names_json is None and results:
+                names = results[0].names
+                class_names_json = tuple(
+                    orjson.dumps(names.get(i, "unknown")).decode()
+                    for i in range(max(names) + 1)
+                ) if names else ()
+
+            # Each boxes.data tensor is Nx6 (xyxy, conf, cls) on the device
+            boxes_per_frame = [result.boxes.data for result in results]
+            counts = [len(boxes) for boxes in boxes_per_frame]
+
+            # One transfer for every detection in the batch
+            if sum(counts) > 0:
+                arr = torch.cat(boxes_per_frame).cpu().numpy()
+            else:
+                arr = np.empty((0, 6), dtype=np.float32)
+
+            # Tensor input bypasses the predictor's own rescaling, so undo
+            # the letterbox to map boxes back to original frame coordinates
+            if letterbox is not None and len(arr) > 0:
+                gain, pad_x, pad_y = letterbox
+                arr[:, [0, 2]] -= pad_x
+                arr[:, [1, 3]] -= pad_y
+                arr[:, :4] /= gain
+                arr[:, [0, 2]] = arr[:, [0, 2]].clip(0, width)
+                arr[:, [1, 3]] = arr[:, [1, 3]].clip(0, height)
+
+            frame_records = []
+            offset = 0
+            for i, count in enumerate(counts):
+                # Slice this frame's rows out of the batch array
+                rows = arr[offset:offset + count]
+                offset += count
+                frame_number = first_frame_number + i
+
+                # Vectorized column extraction: one tolist per column instead
+                # of per-box scalar reads and hasattr probes (the attributes
+                # always exist on Ultralytics results)
+                xyxy_list = rows[:, :4].tolist()
+                conf_list = rows[:, 4].tolist()
+                cls_list = rows[:, 5].astype(int).tolist()
+
+                # Format the NDJSON line directly instead of building per-box
+                # dicts for a serializer to walk; %s keeps the floats'
+                # shortest repr, which is valid JSON
+                detections = ','.join(
+                    '{"bbox":[%s,%s,%s,%s],"confidence":%s,"class_id":%d,"class_name":%s}'
+                    % (
+                        xyxy[0], xyxy[1], xyxy[2], xyxy[3], conf, cls,
+                        class_names_json[cls] if 0 <= cls < len(class_names_json) else '"unknown"'
+                    )
+                    for xyxy, conf, cls in zip(xyxy_list, conf_list, cls_list)
+                )
+
+                timestamp = frame_number / fps if fps > 0 else 0
+                frame_records.append(
+                    ('{"frame_number":%d,"timestamp":%s,"detections":[%s]}'
+                     % (frame_number, timestamp, detections)).encode()
+                )
+
+            return frame_records
+
+        # Function to assemble the final wrapped JSON from metadata + NDJSON body
+        def finalize_results(json_path, ndjson_path, metadata):
+            with open(json_path, 'wb') as out, open(ndjson_path, 'rb') as src:
+                # Open the metadata object and splice in the frames array
+                header = orjson.dumps(metadata)
+                out.write(header[:-1] + b',"frames":[')
+
+                first = True
+                for line in src:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    if not first:
+                        out.write(b',')
+                    out.write(line)
+                    first = False
+
+                out.write(b']}')
+
         # Function to save error information to JSON
         def save_error_json(json_path, error_message):
             error_data = {
@@ -115,47 +325,175 @@ async def predict(job: Job, token=None):
                 "message": error_message,
                 "timestamp": time.time()
             }
-            
-            os.makedirs(os.path.dirname(json_path), exist_ok=True)
-            with open(json_path, 'w') as f:
-                json.dump(error_data, f)
+
+            # The job's output directory already exists
+            with open(json_path, 'wb') as f:
+                f.write(orjson.dumps(error_data))
         
         # Initialize progress
         await job.updateProgress(0)
         
-        # Run prediction with streaming enabled
-        results = model.predict(
-            source=video_path, 
-            conf=confidence,
-            stream=True  # Enable streaming mode
-        )
-        
-        # Process results in streaming mode directly (no callbacks)
-        processed_frames = 0
-        
-        # Iterate through each frame result
-        for result in results:
-            processed_frames += 1
-            
-            # Calculate progress percentage (0-100)
-            progress = min(int((processed_frames / total_frames) * 100), 100)
-            
-            # Update BullMQ job progress
-            await job.updateProgress(progress)
-            
-            # Log progress
-            if processed_frames % 10 == 0 or progress == 100:
-                print(f'Processing frame {processed_frames}/{total_frames} - {progress}% complete')
-            
-            # Extract detection data for current frame
-            frame_data = extract_frame_data(result, processed_frames)
-            
-            # Append to JSON file
-            update_json_results(final_json_path, frame_data)
-            
-            # Optional: Add a small delay to prevent CPU overuse if needed
-            # await asyncio.sleep(0.001)
-        
+        # Frame records flow from the inference producer to the IO consumer
+        # through a bounded queue: the event loop stays free for progress
+        # updates and BullMQ heartbeats while the GPU works, and the
+        # producer blocks if the consumer falls too far behind, capping
+        # memory instead of buffering the whole video
+        loop = asyncio.get_running_loop()
+        record_queue = asyncio.Queue(maxsize=256)
+
+        # Set when the consumer exits so the producer thread stops instead
+        # of blocking forever on a queue nobody drains
+        stop_infer = threading.Event()
+
+        # GPU letterbox state for the device-resident path: a reusable FP16
+        # canvas pre-filled with the 114 pad value, plus the geometry needed
+        # to map boxes back to frame coordinates
+        use_gpu_pipeline = torch.cuda.is_available()
+        if use_gpu_pipeline:
+            gain = min(IMGSZ / height, IMGSZ / width)
+            scaled_h, scaled_w = round(height * gain), round(width * gain)
+            pad_x = (IMGSZ - scaled_w) // 2
+            pad_y = (IMGSZ - scaled_h) // 2
+            canvas = torch.full(
+                (BATCH_SIZE, 3, IMGSZ, IMGSZ), 114 / 255,
+                dtype=torch.float16, device='cuda'
+            )
+            preprocess_stream = torch.cuda.Stream()
+
+            if not HAS_DECORD:
+                # Staging buffers for OpenCV-decoded frames, allocated once:
+                # page-locked host memory plus a matching device tensor so
+                # each batch moves with a single async host->device copy
+                # instead of fresh allocations
+                host_buf = torch.empty(
+                    (BATCH_SIZE, height, width, 3), dtype=torch.uint8, pin_memory=True
+                )
+                dev_buf = torch.empty_like(host_buf, device='cuda')
+
+        def run_inference():
+            # Runs in a worker thread: the blocking decode + GPU work lives
+            # here so it never stalls the event loop. Reads the video in
+            # chunks of BATCH_SIZE frames and runs one inference call per
+            # chunk, amortizing kernel launch and transfer overhead.
+            processed = 0
+            try:
+                for batch in read_batches(video_path):
+                    # Bail out if the consumer died; its teardown drained
+                    # the queue, so the previous put has completed
+                    if stop_infer.is_set():
+                        break
+
+                    if use_gpu_pipeline:
+                        if not torch.is_tensor(batch):
+                            # Stage OpenCV frames in the pinned host buffer;
+                            # the device copy is issued on the side stream
+                            n = len(batch)
+                            host_buf[:n].copy_(torch.from_numpy(np.stack(batch)))
+                        else:
+                            n = batch.shape[0]
+
+                        # Letterbox on the GPU in a side stream (FP16,
+                        # aspect-preserving resize into the pre-filled
+                        # canvas), overlapping with the previous batch's
+                        # inference
+                        with torch.cuda.stream(preprocess_stream):
+                            if torch.is_tensor(batch):
+                                # NVDEC left RGB frames on the device already
+                                frames_dev = batch
+                            else:
+                                # One async host->device copy per batch, then
+                                # flip BGR to RGB on the device
+                                dev_buf[:n].copy_(host_buf[:n], non_blocking=True)
+                                frames_dev = dev_buf[:n].flip(-1)
+                            x = frames_dev.permute(0, 3, 1, 2).to(torch.float16).div_(255.0)
+                            x = torch.nn.functional.interpolate(
+                                x, size=(scaled_h, scaled_w), mode='bilinear', align_corners=False
+                            )
+                            canvas[:n, :, pad_y:pad_y + scaled_h, pad_x:pad_x + scaled_w].copy_(x)
+                        torch.cuda.current_stream().wait_stream(preprocess_stream)
+                        results = model.predict(source=canvas[:n], conf=confidence, verbose=False)
+                        letterbox = (gain, pad_x, pad_y)
+                    else:
+                        # CPU-only fallback: run prediction on the whole
+                        # batch at once with the predictor's own preprocess
+                        results = model.predict(
+                            source=batch,
+                            conf=confidence,
+                            imgsz=IMGSZ,
+                            verbose=False
+                        )
+                        letterbox = None
+
+                    # Extract detection data for the whole batch with one transfer
+                    batch_records = extract_batch_data(results, processed + 1, letterbox)
+                    processed += len(batch_records)
+
+                    # Blocking put: exerts backpressure on the producer
+                    # thread when the queue is full
+                    asyncio.run_coroutine_threadsafe(
+                        record_queue.put(batch_records), loop
+                    ).result()
+            finally:
+                # Sentinel: no more batches (always sent, even on error)
+                asyncio.run_coroutine_threadsafe(record_queue.put(None), loop).result()
+
+        async def consume_records():
+            # Drain frame records as the inference thread produces them,
+            # overlapping NDJSON writes and progress reporting with GPU work
+            processed_frames = 0
+            last_reported_progress = -1
+            last_log = 0.0
+
+            try:
+                while True:
+                    batch_records = await record_queue.get()
+                    if batch_records is None:
+                        break
+
+                    # Emit one encoded line per frame in the batch
+                    for frame_line in batch_records:
+                        processed_frames += 1
+
+                        # Calculate progress percentage (0-100)
+                        progress = min(int((processed_frames / total_frames) * 100), 100)
+
+                        # Only report progress when the percentage actually
+                        # changes, and fire-and-forget so the Redis round-trip
+                        # doesn't stall the inference loop
+                        if progress != last_reported_progress:
+                            asyncio.create_task(job.updateProgress(progress))
+                            last_reported_progress = progress
+
+                        # Log at most once per second instead of every few frames
+                        now = time.monotonic()
+                        if now - last_log > 1.0 or progress == 100:
+                            logger.info('Processing frame %d/%d - %d%% complete', processed_frames, total_frames, progress)
+                            last_log = now
+
+                        # Append the pre-encoded line to the NDJSON file
+                        frames_file.write(frame_line + b'\n')
+            finally:
+                # On any exit (including an error mid-write) stop the
+                # producer and free queue slots so a put blocked on the
+                # full queue can complete and the thread can exit
+                stop_infer.set()
+                while not record_queue.empty():
+                    record_queue.get_nowait()
+
+            return processed_frames
+
+        # Run producer and consumer concurrently; gather surfaces exceptions
+        # raised on either side. 'wb' truncates any leftover NDJSON from a
+        # previous attempt of the same job id, and the context manager
+        # closes the handle (flushing the 1 MiB buffer) even on error
+        with open(ndjson_path, 'wb', buffering=1 << 20) as frames_file:
+            _, processed_frames = await asyncio.gather(
+                asyncio.to_thread(run_inference), consume_records()
+            )
+
+        # Wrap metadata + frame records into the final JSON once
+        finalize_results(final_json_path, ndjson_path, metadata)
+
         # Ensure progress is at 100% when complete
         await job.updateProgress(100)
         
@@ -171,12 +509,10 @@ async def predict(job: Job, token=None):
         # Update progress to 100% even on error
         await job.updateProgress(100)
         
-        # Save error to JSON
+        # Save error to JSON (the output directory was created up front)
         try:
-            error_json_path = Path(f"./temp_results/{job.id}/error.json")
-            os.makedirs(os.path.dirname(error_json_path), exist_ok=True)
-            with open(error_json_path, 'w') as f:
-                json.dump({"status": "error", "message": str(e)}, f)
+            with open(output_dir / "error.json", 'wb') as f:
+                f.write(orjson.dumps({"status": "error", "message": str(e)}))
         except:
             pass
             
@@ -187,30 +523,33 @@ async def main():
     shutdown_event = asyncio.Event()
 
     def signal_handler(signal, frame):
-        print("Signal received, shutting down.")
+        logger.info("Signal received, shutting down.")
         shutdown_event.set()
 
     # Assign signal handlers to SIGTERM and SIGINT
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
-    # Redis connection settings
-    redis_connection = {
-        "connection": "redis://default:password@/localhost:6379"
+    # Worker settings: one job at a time, since a single GPU can't run
+    # two inference pipelines without contending
+    worker_opts = {
         # Replace with your actual Redis credentials
+        "connection": "redis://default:password@/localhost:6379",
+        "concurrency": 1
     }
 
     # Create worker with prediction function
-    worker = Worker("videoProcessingQueue", predict, redis_connection)
-    print("Worker started and waiting for jobs...")
+    worker = Worker("videoProcessingQueue", predict, worker_opts)
+    logger.info("Worker started and waiting for jobs...")
 
     # Wait until the shutdown event is set
     await shutdown_event.wait()
 
     # Close the worker
-    print("Cleaning up worker...")
+    logger.info("Cleaning up worker...")
     await worker.close()
-    print("Worker shut down successfully.")
+    logger.info("Worker shut down successfully.")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
\ No newline at end of file